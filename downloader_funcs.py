@@ -1,18 +1,69 @@
 # downloader_funcs.py
 # will contain functions to be delegated to threads in main.py
 
+import csv
+import functools
 import os
+import re
+import shutil
+import socket
+import sys
+import threading
+from collections import deque
+import openpyxl
 import requests as rq
 import pandas as pd
+import urllib3.util.connection
+from requests.adapters import HTTPAdapter
+
+
+# threads mostly sit waiting on the network (which releases the GIL), so we can afford more of them than concurrent.futures' CPU-based default
+DEFAULT_CONNECTIONS = 32
+
+# Windows and macOS filesystems (by default) ignore upper/lower case in file names, so the check for already-downloaded files should too
+CASE_INSENSITIVE_FILENAMES = os.name == "nt" or sys.platform == "darwin"
+
+# amount of different hosts the shared session keeps open connections to. Inputs often link to many hosts, 
+# and once there are more than this the least recently used host's connections are closed and have to be opened again later
+HOST_POOLS = 128
+
+# size in bytes of the chunks downloaded files are streamed to disk in
+WRITE_CHUNK_SIZE = 1 << 20
+
+# largest body in bytes that is read anyway from an unwanted response, to keep its connection open for reuse
+DISCARD_READ_LIMIT = 1 << 16
+
+# other names the content-type header may use for a download_filetype
+FILETYPE_ALIASES = {
+    "jpg": ["jpeg"],
+    "jpeg": ["jpg"],
+    "tif": ["tiff"],
+    "tiff": ["tif"],
+    "htm": ["html", "xhtml"],
+    "html": ["xhtml"],
+    "txt": ["plain"],
+}
+
+# amount of finished reports to gather before the report-writing thread appends them to the report file, 
+# and how many seconds it waits between checking
+REPORT_BATCH_SIZE = 1000
+REPORT_FLUSH_INTERVAL = 1
+
+# amount of different (host, port) DNS lookups remembered for the rest of the run
+DNS_CACHE_SIZE = 1024
+
+# columns of the report, in the order they're written
+REPORT_COLUMNS = ["name", "success?", "from url", "exceptions encountered"]
 
 
 ### global values are set when init() is run
 
-def init(settings: dict) -> None:
+def init(settings: dict, connections_limit: int | None = None) -> None:
     """
     Intializes chosen settings in the global scope of file downloader thread module. Important to run this function first!
+    connections_limit should match the amount of threads that will be downloading at a time, so every thread can keep a connection open in the shared session.
     """
-    global INPUT_FILE, REPORT_FILE, DL_FOLDER, TEMP_DL_FOLDER, LINK_COLS, NAMING_COL, FILETYPE, IS_BIN, DOWNLOAD_ALL, TIMEOUT
+    global INPUT_FILE, REPORT_FILE, REPORT_FORMAT, DL_FOLDER, TEMP_DL_FOLDER, LINK_COLS, NAMING_COL, FILETYPE, SUFFIX, FILETYPE_RE, IS_BIN, DOWNLOAD_ALL, TIMEOUT, SESSION, EXISTING, USE_TMPFILE
 
     try:
         INPUT_FILE = settings["input_file"]
@@ -24,6 +75,10 @@ def init(settings: dict) -> None:
         NAMING_COL = settings["naming_column"]
 
         FILETYPE = settings["download_filetype"]
+        SUFFIX = "." + FILETYPE
+        # matches FILETYPE (or one of its aliases) as a whole word in a content-type header, e.g. "image/jpeg" for "jpg"
+        names = [FILETYPE] + FILETYPE_ALIASES.get(FILETYPE.lower(), [])
+        FILETYPE_RE = re.compile(r"\b(" + "|".join(re.escape(n) for n in names) + r")\b", re.IGNORECASE)
         IS_BIN = settings["download_is_binary_file"]
 
         DOWNLOAD_ALL = settings["do_download_all"]
@@ -33,12 +88,48 @@ def init(settings: dict) -> None:
         print("All fields in settings must be set; refer to examples in main.py for syntax. Exiting...")
         exit(1)
 
+    # the report's file type follows from its extension, so the two can't disagree
+    REPORT_FORMAT = "csv" if os.path.splitext(REPORT_FILE)[1].lower() == ".csv" else "xlsx"
+
     ### create the folders we need
     # don't need to do INPUT_FILE since it logically must exist at a path already
     os.makedirs(os.path.dirname(REPORT_FILE), exist_ok=True)
     os.makedirs(os.path.dirname(DL_FOLDER), exist_ok=True)
     os.makedirs(os.path.dirname(TEMP_DL_FOLDER), exist_ok=True)
 
+    ### check whether files can be written without a name first (Linux O_TMPFILE), otherwise TEMP_DL_FOLDER is used
+    USE_TMPFILE = False
+    if hasattr(os, "O_TMPFILE") and os.path.isdir("/proc/self/fd"):
+        probe_path = f"{DL_FOLDER}.probe-{os.getpid()}"
+        try:
+            fd = os.open(DL_FOLDER, os.O_TMPFILE | os.O_WRONLY, 0o666)
+            try:
+                os.link(f"/proc/self/fd/{fd}", probe_path)
+            finally:
+                os.close(fd)
+            os.remove(probe_path)
+            USE_TMPFILE = True
+        except OSError:
+            # not supported by the filesystem (or kernel)
+            pass
+
+    ### list the already-downloaded files once, instead of asking the filesystem about every row
+    EXISTING = set()
+    if not DOWNLOAD_ALL:
+        with os.scandir(DL_FOLDER) as entries:
+            EXISTING = {_filename_key(e.name) for e in entries if e.is_file()}
+
+    ### one session shared by all threads, so connections to a host are kept alive and reused instead of reconnecting for every link
+    # pool_connections is how many hosts to keep connections around for, pool_maxsize is how many connections per host
+    pool_size = connections_limit or DEFAULT_CONNECTIONS
+    adapter = HTTPAdapter(pool_connections=HOST_POOLS, pool_maxsize=pool_size, max_retries=0)
+    SESSION = rq.Session()
+    SESSION.mount("http://", adapter)
+    SESSION.mount("https://", adapter)
+
+    # every new connection to a host we've already looked up reuses the addresses from the first lookup, instead of asking DNS again
+    urllib3.util.connection.create_connection = _create_connection_cached_dns
+
 
 
 ### some primary functions main thread will use
@@ -73,34 +164,73 @@ def load_input() -> pd.DataFrame:
     """
 
     cols = [NAMING_COL] + LINK_COLS
-    df = pd.read_excel(INPUT_FILE, usecols=cols, engine_kwargs={"read_only":True})
+    # calamine (rust) engine parses the whole sheet a lot faster than openpyxl
+    df = pd.read_excel(INPUT_FILE, usecols=cols, engine="calamine")
+    # usecols keeps the order of the sheet, so put the columns in the order we promise
+    df = df[cols]
+    # empty cells become pd.NA (instead of float nan) all at once, so threads can skip them without converting every link to a string
+    df[LINK_COLS] = df[LINK_COLS].astype("string")
     return df
 
 
-def write_report(reports: list[pd.Series]) -> None:
+def report_writer(reports: deque[dict], done: threading.Event, errors: list[Exception]) -> None:
     """
-    Writes a collection of reports (list of pandas.Series objects) to an excel file at path report_file. Will overwrite previous reports at this path
+    The routine for the report-writing thread, which runs alongside the file-downloading threads.
+
+    Whenever (REPORT_BATCH_SIZE) reports (dicts with REPORT_COLUMNS as keys) have piled up in reports, they are taken out and appended to an excel or csv file (depending on REPORT_FORMAT) at path report_file, 
+    so finished reports don't stay in memory until every download is done. Once done is set, the remaining reports are written and the file is finished. Will overwrite previous reports at this path.
+    Rows are written in the order their downloads finished.
+    A thread can't raise exceptions to the main thread, so if writing fails the exception is added to errors instead (for the main thread to raise once done), 
+    and reports are thrown away from then on so they don't pile up for the rest of the run.
     """
 
-    # turn our reports into a dataframe for nice printing
-    df = pd.DataFrame()
-    for item in reports:
-        df = pd.concat([df, item.to_frame().T], ignore_index=True)
-        # sort the rows of the report by the names of downloaded (or attempted) files
-        df = df.sort_values(by=['name'])
+    try:
+        _write_reports(reports, done)
+    except Exception as e:
+        errors.append(e)
+        while not done.wait(timeout=REPORT_FLUSH_INTERVAL):
+            reports.clear()
+        reports.clear()
 
-    # write it
-    with pd.ExcelWriter(REPORT_FILE, mode='w') as writer:  
-        df.to_excel(writer)
 
+def _write_reports(reports: deque[dict], done: threading.Event) -> None:
+    """
+    Does the actual work of report_writer(), see its description.
+    """
+
+    # both file types are written row by row as we go, instead of being built in memory first
+    if REPORT_FORMAT == "csv":
+        f = open(REPORT_FILE, "w", newline="", encoding="utf-8", buffering=1<<20)
+        append_row = csv.writer(f).writerow
+    else:
+        wb = openpyxl.Workbook(write_only=True)
+        ws = wb.create_sheet("report")
+        append_row = ws.append
 
-def thread_job(input_row: pd.DataFrame, reports: list[pd.Series]) -> None:
+    try:
+        append_row(REPORT_COLUMNS)
+        finished = False
+        while not finished:
+            finished = done.wait(timeout=REPORT_FLUSH_INTERVAL)
+            if finished or len(reports) >= REPORT_BATCH_SIZE:
+                while reports:
+                    report = reports.popleft()
+                    append_row([report[col] for col in REPORT_COLUMNS])
+    finally:
+        if REPORT_FORMAT == "csv":
+            f.close()
+
+    if REPORT_FORMAT != "csv":
+        wb.save(REPORT_FILE)
+
+
+def thread_job(input_row: tuple, reports: deque[dict]) -> None:
     """
     The routine for one file-downloading thread. 
     
     Given a row of data from the input file, the thread will attempt to download just one file from the contained list of links.
-    The first link to successfully return the kind of file we ask for (download_filetype) will be saved in the chosen downloads folder, and the thread will add a summary to the reports list.
-    If no links produce the kind of file we're looking for, then no file will be added to downloads folder, but a summary is still added to the reports list.
+    The first link to successfully return the kind of file we ask for (download_filetype) will be saved in the chosen downloads folder, and the thread will add a summary to the reports deque.
+    If no links produce the kind of file we're looking for, then no file will be added to downloads folder, but a summary is still added to the reports deque.
     """
 
     name, links = _unpack_input(input_row)
@@ -109,76 +239,109 @@ def thread_job(input_row: pd.DataFrame, reports: list[pd.Series]) -> None:
     if DOWNLOAD_ALL == False and _file_exists(name):
         return
 
-    # make http request(s) for the files
+    # make http request(s) for the files, the first valid one is saved in the downloads folder
     exceptions = []
-    response = _try_links(links, exceptions)
-    if response is not None:
-        # if successful: open pdf download folder and save pdf there
-        _save_file(response, name)
-        print(f"Downloaded \"{name}\"")
-        # add success/failure to report collection
-        _add_to_report(reports, name, success=True, response=response, exceptions=exceptions)
-    else:
-        _add_to_report(reports, name, success=False, exceptions=exceptions)
+    response = None
+    try:
+        response = _try_links(links, name, exceptions)
+        if response is not None:
+            print(f"Downloaded \"{name}\"")
+    except Exception as e:
+        # anything unexpected only costs this row (which is still reported), never the rows other threads are working on
+        exceptions.append(e)
+
+    # add success/failure to report collection
+    _add_to_report(reports, name, success=response is not None, response=response, exceptions=exceptions)
 
 
 
 ### functions helping each thread do its job
 
-def _unpack_input(input, name_col_i=0) -> tuple[str, list[str]]:
+def _unpack_input(input: tuple, name_col_i=0) -> tuple[str, list[str]]:
     """
-    Unpacks an input row from dataset into a name (to be given to a future downloaded file) and a list of links, which are returned. "nan" values are removed.
+    Unpacks an input row (plain tuple) from dataset into a name (to be given to a future downloaded file) and a list of links, which are returned. Missing (pd.NA) links are removed.
     
     name_col_i indicates the index of the column that contains the name, the rest of the input_row is assumed to be links.
     name_col_i defaults to being the first column, since this is the how load_input() constructs a row of data. 
     """
 
     name = input[name_col_i]
-    # all other columns are assumed to contain links
-    links = list(input[:name_col_i] + input[name_col_i+1:])
-    # remove nan values
-    links = [x for x in links if str(x) != "nan"]
+    # all other columns are assumed to contain links, remove empty cells (load_input() has already turned them into pd.NA)
+    if name_col_i == 0:
+        links = [x for x in input[1:] if x is not pd.NA]
+    else:
+        links = [x for x in input[:name_col_i] + input[name_col_i+1:] if x is not pd.NA]
     return name, links
 
 
 def _file_exists(name: str) -> bool:
     """
-    Checks download folder for whether a file named (name).FILETYPE already exists, returns True or False
+    Checks download folder for whether a file named (name).FILETYPE already existed when init() was run, returns True or False
     """
-    if os.path.isfile(DL_FOLDER + name + "." + FILETYPE):
+    if _filename_key(f"{name}{SUFFIX}") in EXISTING:
         return True
     return False
 
 
-def _try_links(links: list[str], exceptions: list[Exception]) -> rq.Response | None:
+def _filename_key(filename: str) -> str:
+    """
+    Returns filename the way the filesystem compares names: lowercased where case doesn't matter (CASE_INSENSITIVE_FILENAMES), unchanged otherwise.
+    """
+
+    if CASE_INSENSITIVE_FILENAMES:
+        return os.path.normcase(filename).lower()
+    return filename
+
+
+def _try_links(links: list[str], name: str, exceptions: list[Exception]) -> rq.Response | None:
     """
-    Tries to download a file from given list of links (invalid URLs are skipped). 
+    Tries to download a file from given list of links (invalid URLs are skipped) and save it with _save_file() as name.FILETYPE. 
     A connection will time out after TIMEOUT seconds.
-    First link to produce a valid file of type FILETYPE returns its http response, which contains the content of the desired file. 
+    First link to produce a valid file of type FILETYPE, which is then saved completely, returns its (closed) http response. Remaining links are not tried.
     If no links produce a valid file, then returns None.
     If any exceptions are encountered, they will be added to exceptions list.
     """
 
-    res = None
     for url in links:
         try:
-            r = rq.get(url, timeout=TIMEOUT)
+            r = SESSION.get(url, timeout=TIMEOUT, stream=True)
+            if r.status_code == 200 and _is_correct_filetype(r):
+                # the body is only downloaded while saving, so the connection can still fail here and we move on to the next link
+                try:
+                    _save_file(r, name)
+                finally:
+                    r.close()
+                return r
+            # not what we're looking for
+            _discard(r)
         except Exception as e:
             # fail silently, but save exception for adding to the report
             exceptions.append(e)
-        else:
-            if r.status_code == 200 and _is_correct_filetype(r):
-                res = r
-    return res
+    return None
+
+
+def _discard(response: rq.Response) -> None:
+    """
+    Closes an http response we don't want the content of. 
+    Small bodies (like most error pages) are read first, so the connection can go back to the session's pool and be reused for the next link to that host,
+    bigger or unknown-size bodies are not downloaded at all and their connection is dropped instead.
+    """
+
+    length = response.headers.get("content-length", "")
+    try:
+        if length.isdigit() and int(length) <= DISCARD_READ_LIMIT:
+            response.content
+    finally:
+        response.close()
 
 
 def _is_correct_filetype(response: rq.Response) -> bool:
     """
     Checks if http response contains a valid file of type FILETYPE, returns True if it does and False if not.
-    Very hacky solution, so may be incorrect for more obscure values of FILETYPE.
+    Only looks at the content-type header, so may be incorrect for more obscure values of FILETYPE. A missing header counts as the wrong filetype.
     """
 
-    if FILETYPE in response.headers["content-type"]:
+    if FILETYPE_RE.search(response.headers.get("content-type", "")):
         return True
     return False
 
@@ -186,26 +349,70 @@ def _is_correct_filetype(response: rq.Response) -> bool:
 def _save_file(response: rq.Response, name: str) -> None:
     """
     Save the file from http response as a file in DL_FOLDER/name.FILETYPE. Overwrites already present files with the same path.
-    Whether the contents of the file are written to file as raw bytes or text depends on IS_BIN setting.
+    A file only shows up at its final path once it's fully written.
+    """
+
+    final_path = f"{DL_FOLDER}{name}{SUFFIX}"
+    if USE_TMPFILE:
+        # (Linux) write to a nameless file in the downloads folder, then give it its name in one step once it's done
+        fd = os.open(DL_FOLDER, os.O_TMPFILE | os.O_WRONLY, 0o666)
+        try:
+            _write_response(fd, response)
+            try:
+                os.link(f"/proc/self/fd/{fd}", final_path)
+            except FileExistsError:
+                # linking can't overwrite, so link to a name unique to this thread and move that over the old file
+                part_path = f"{final_path}.{os.getpid()}-{threading.get_ident()}.part"
+                os.link(f"/proc/self/fd/{fd}", part_path)
+                try:
+                    os.replace(part_path, final_path)
+                except Exception:
+                    _remove_if_exists(part_path)
+                    raise
+        finally:
+            os.close(fd)
+    else:
+        # save file to temp folder first
+        save_path = f"{TEMP_DL_FOLDER}{name}{SUFFIX}"
+        try:
+            _write_response(save_path, response)
+            # then move it to actual downloads folder
+            os.replace(save_path, final_path)
+        except Exception:
+            # don't leave a half-written file behind in the temp folder
+            _remove_if_exists(save_path)
+            raise
+
+
+def _remove_if_exists(path: str) -> None:
+    """
+    Removes the file at path, if there is one.
     """
 
-    # idea: switch to iterating thru response content/text stream-style in case we get huge files back?
-    # tried it. kinda slow compared to downloading the content immediately. not worth it for files that can be contained in memory
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
 
-    # save file to temp folder first
-    save_path = TEMP_DL_FOLDER + name + "." + FILETYPE
+
+def _write_response(file: str | int, response: rq.Response) -> None:
+    """
+    Writes the content of http response to file, given as a path or as an open file descriptor (which is left open).
+    Whether the contents of the file are written to file as raw bytes or text depends on IS_BIN setting.
+    """
+
+    closefd = not isinstance(file, int)
     if IS_BIN:
-        with open(save_path, "wb") as f:
-            f.write(response.content)
+        # 1 MB chunks and file buffer: big files take far fewer write calls, while a thread still never holds more than one chunk in memory
+        with open(file, "wb", buffering=WRITE_CHUNK_SIZE, closefd=closefd) as f:
+            response.raw.decode_content = True
+            shutil.copyfileobj(response.raw, f, length=WRITE_CHUNK_SIZE)
     else:
-        with open(save_path, "w", encoding=response.encoding) as f:
+        with open(file, "w", encoding=response.encoding, closefd=closefd) as f:
             f.write(response.text)
-    # then move it to actual downloads folder
-    final_path = DL_FOLDER + name + "." + FILETYPE
-    os.replace(save_path, final_path)
 
 
-def _add_to_report(reports: list[pd.Series], 
+def _add_to_report(reports: deque[dict], 
                    name: str, 
                    success: bool, 
                    response: rq.Response | None = None, 
@@ -215,7 +422,7 @@ def _add_to_report(reports: list[pd.Series],
     Name is the identifier for each row of items, and will probably correspond to values in NAMING_COL.
     If http response is given, then the url of the response will be added to report.
     If exceptions list is given, then any exceptions encountered will be added to report.
-    Actual report file should be written after threads are done by the main thread, using write_report().
+    The report file is written by the thread running report_writer().
     """
 
     # NOTE to self: accessing shared variables/memory is danger territory for threads
@@ -230,5 +437,34 @@ def _add_to_report(reports: list[pd.Series],
     if exceptions:
         content["exceptions encountered"] = " ; AND ; ".join([str(e) for e in exceptions])
 
-    s = pd.Series(content)
-    reports.append(s) # appending is thread-safe https://docs.python.org/3/faq/library.html#what-kinds-of-global-value-mutation-are-thread-safe
+    reports.append(content) # deque's append and popleft (used by report_writer()) are thread-safe, also without the GIL https://docs.python.org/3/library/collections.html#collections.deque
+
+
+# urllib3's own function for opening connections, which _create_connection_cached_dns() wraps
+_urllib3_create_connection = urllib3.util.connection.create_connection
+
+def _create_connection_cached_dns(address: tuple[str, int], *args, **kwargs) -> socket.socket:
+    """
+    Stand-in for urllib3.util.connection.create_connection() (installed by init()) which resolves the host through _resolve()'s cache.
+    Tries each resolved address in turn like urllib3 does, and raises the last error if none of them can be connected to.
+    """
+
+    host, port = address
+    err = OSError(f"No addresses found for {host}")
+    for ip in _resolve(host.strip("[]"), port):
+        try:
+            return _urllib3_create_connection((ip, port), *args, **kwargs)
+        except OSError as e:
+            err = e
+    raise err
+
+
+@functools.lru_cache(maxsize=DNS_CACHE_SIZE)
+def _resolve(host: str, port: int) -> tuple[str, ...]:
+    """
+    Looks up the IP addresses of host (in the order getaddrinfo returns them), remembering the answer. Failed lookups raise socket.gaierror and aren't remembered.
+    """
+
+    infos = socket.getaddrinfo(host, port, urllib3.util.connection.allowed_gai_family(), socket.SOCK_STREAM)
+    # several entries can share an address, keep the first of each
+    return tuple(dict.fromkeys(sockaddr[0] for *_, sockaddr in infos))
@@ -3,6 +3,11 @@
 # this will be the main controller for the threads
 
 import concurrent.futures as cf
+import itertools
+import multiprocessing
+import sys
+import threading
+from collections import deque
 import downloader_funcs as dl
 
 
@@ -18,6 +23,7 @@ settings_example = dict(
     #                       OR "../sibling_folder_to_current_folder/example.txt"
     #   folder:         "(...absolute or relative start...)/just_the_folder/"
     input_file = "C:/path/to/GRI_2017_2020.xlsx",
+    # a report_file ending in ".csv" is written as csv (a lot faster to write for big inputs), anything else as an excel file
     report_file = "./reports/Metadata2024.xlsx",
     downloads_folder = "./PDFs/",
     temporary_downloads_folder = "./PDFs_temp/",
@@ -83,17 +89,29 @@ settings_html = dict(
 # NOTE: change this value to use other "settings profiles"
 SETTINGS = settings_jpeg 
 
-# Integer number (e.g. 10) of threads that can be active and download files at a time, 
-# set to None to use the concurrent.futures module's default choice
+# Integer number (e.g. 10) of threads that can be active and download files at a time (per process), 
+# set to None to use downloader_funcs.DEFAULT_CONNECTIONS
 CONNECTIONS_LIMIT = None      
 
+# Integer number (e.g. 4) of processes to split the rows of input between, each running its own threads. Can help when there's enough 
+# input for the per-row work to keep a single process' CPU busy, 
+# set to None to do everything in this process. 
+# Ignored when running on a free-threaded Python build (e.g. "python3.13t") with the GIL disabled, since the threads then already run in parallel. 
+# NOTE: each process keeps the reports for all of its rows in memory and hands them back only once they're all done, 
+# so reports are only written to file in batches as they go when this is None
+PROCESS_COUNT = None
+
 #############################################
 
 
 
-def main(connections_limit: int | None = None):
+def main(connections_limit: int | None = None, process_count: int | None = None):
+    # same amount of threads as pooled connections, so no thread has to wait for (or open) an extra connection
+    if connections_limit is None:
+        connections_limit = dl.DEFAULT_CONNECTIONS
+
     # initialize input values for module functions
-    dl.init(SETTINGS)
+    dl.init(SETTINGS, connections_limit)
 
     # test inputted file paths for validity before we get started
     dl.test_settings()
@@ -101,22 +119,57 @@ def main(connections_limit: int | None = None):
     # read data
     data = dl.load_input()
 
-    # pass each row of data to threads
-    reports = []
-    with cf.ThreadPoolExecutor(max_workers=connections_limit) as executor:
-        fs = []
-        for row in data.itertuples(index=False, name="datarow"):
-            fs.append(executor.submit(dl.thread_job, row, reports))
+    # sys._is_gil_enabled() only exists from Python 3.13, older versions always have the GIL
+    gil_enabled = getattr(sys, "_is_gil_enabled", lambda: True)()
+
+    # reports are written to file by their own thread while the downloads are still going
+    reports = deque()
+    done = threading.Event()
+    writer_errors = []
+    writer = threading.Thread(target=dl.report_writer, args=(reports, done, writer_errors))
+    writer.start()
+
+    try:
+        if process_count is None or process_count <= 1 or not gil_enabled:
+            download_rows(data, connections_limit, reports)
+        else:
+            # every process gets every (process_count)th row, and initializes its own copy of the module. 
+            # processes are spawned fresh rather than forked, since forking while the report-writing thread runs can deadlock
+            chunks = [data.iloc[i::process_count] for i in range(process_count)]
+            with cf.ProcessPoolExecutor(max_workers=process_count, mp_context=multiprocessing.get_context("spawn"), 
+                                        initializer=dl.init, initargs=(SETTINGS, connections_limit)) as executor:
+                for chunk_reports in executor.map(download_rows, chunks, itertools.repeat(connections_limit)):
+                    reports.extend(chunk_reports)
+    finally:
+        # let the writer write the remaining reports and finish the report file
+        done.set()
+        writer.join()
+
+    # the writer thread can't raise to this one, so it hands over what went wrong instead
+    if writer_errors:
+        raise writer_errors[0]
 
-    # wait for threads to complete their jobs so we don't write the report too soon
-    cf.wait(fs)
+    return
 
-    # write gathered reports from threads to file
-    dl.write_report(reports)
 
-    return
+def download_rows(data, connections_limit: int, reports: deque | None = None) -> deque:
+    """
+    Passes each row of data to a pool of (connections_limit) threads, which add their reports to reports (a new deque if not given). Returns reports once all of them are done.
+    """
+
+    if reports is None:
+        reports = deque()
+
+    # pass each row of data to threads, leaving the with-block waits for all of them
+    with cf.ThreadPoolExecutor(max_workers=connections_limit) as executor:
+        rows = data.itertuples(index=False, name=None)
+        # going through the results lets each finished job be freed right away. thread_job() reports its own errors, so one row can't stop the rest
+        for _ in executor.map(dl.thread_job, rows, itertools.repeat(reports)):
+            pass
+
+    return reports
 
 
 if __name__ == "__main__":
 
-    main(connections_limit=CONNECTIONS_LIMIT)
\ No newline at end of file
+    main(connections_limit=CONNECTIONS_LIMIT, process_count=PROCESS_COUNT)
\ No newline at end of file